@@ -1,7 +1,10 @@
 import streamlit as st
 import pandas as pd
-from docxtpl import DocxTemplate
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from renderer import write_all
 import io
+import tempfile
 import zipfile
 import re
 
@@ -12,25 +15,56 @@ st.title("📝 Thai Contract Automation Tool")
 st.markdown("Upload your contract template (.docx) and your data (.csv) to generate contracts.")
 
 # --- Helper Function for Auto-Increment ---
-def increment_id(start_id, index):
-    # Find the last number in the string
-    match = re.search(r'(\d+)$', start_id)
+# Trailing run of digits in a contract ID (the part that gets incremented)
+_TAIL_DIGITS = re.compile(r'(\d+)$')
+
+def make_id_incrementer(start_id):
+    # Returns index -> contract ID; the regex and slicing run once per batch, not per contract
+    match = _TAIL_DIGITS.search(start_id)
     if match:
         number_str = match.group(1)
         number_len = len(number_str)
         start_num = int(number_str)
-        
-        # Calculate new number
-        new_num = start_num + index
+        prefix = start_id[:match.start()]
         
         # Pad with zeros to match original length (e.g. 001 -> 002)
-        new_number_str = str(new_num).zfill(number_len)
-        
-        # Replace the old number with the new number
-        return start_id[:match.start()] + new_number_str + start_id[match.end():]
+        return lambda index: prefix + str(start_num + index).zfill(number_len)
     else:
         # If no number found at end, just append -1, -2, etc.
-        return f"{start_id}-{index + 1}"
+        return lambda index: f"{start_id}-{index + 1}"
+
+# --- Helper Function for CSV Loading ---
+def load_csv(raw, usecols=None):
+    # Thai exports are usually UTF-8, older ones are TIS-620.
+    # The PyArrow parser only reads UTF-8, so transcode TIS-620 files first.
+    try:
+        raw.decode('utf-8')
+    except UnicodeDecodeError:
+        raw = raw.decode('tis-620').encode('utf-8')
+    # Every cell is read as the literal text in the file, whether or not the mapping has been
+    # confirmed: IDs keep their leading zeros and empty cells stay empty strings
+    # Quoted cells may span lines (multi-line addresses)
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+    header = pa_csv.open_csv(io.BytesIO(raw), parse_options=parse_options).schema.names
+    convert_options = pa_csv.ConvertOptions(
+        column_types={name: pa.string() for name in header},
+        include_columns=list(usecols or []),
+    )
+    table = pa_csv.read_csv(io.BytesIO(raw), parse_options=parse_options, convert_options=convert_options)
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+# --- Helper Functions for Downloads ---
+def read_zip(zip_file):
+    # Read through the handle the session already holds: a delete-on-close temp file
+    # cannot be opened a second time by name on Windows
+    zip_file.seek(0)
+    return zip_file.read()
+
+def discard_zip():
+    # Closing the temp file deletes it from disk
+    zip_file = st.session_state.pop('_zip_file', None)
+    if zip_file is not None:
+        zip_file.close()
 
 # --- Sidebar: Uploads ---
 st.sidebar.header("1. Upload Files")
@@ -40,10 +74,14 @@ csv_file = st.sidebar.file_uploader("Upload Data (.csv)", type=["csv"])
 # --- Main Logic ---
 if docx_file and csv_file:
     try:
-        try:
-            df = pd.read_csv(csv_file, encoding='utf-8')
-        except UnicodeDecodeError:
-            df = pd.read_csv(csv_file, encoding='tis-620')
+        # Keep the parsed CSV in the session so reruns skip re-reading and re-parsing the upload.
+        # This is the only copy of the frame (no st.cache_data), so confirming the mapping below
+        # really replaces it with the slim one.
+        csv_key = (csv_file.file_id, csv_file.name, csv_file.size)
+        if st.session_state.get('_csv_key') != csv_key:
+            st.session_state._df = load_csv(csv_file.getvalue())
+            st.session_state._columns = st.session_state._df.columns.tolist()
+            st.session_state._csv_key = csv_key
         
         st.success("Files uploaded successfully!")
         
@@ -61,7 +99,7 @@ if docx_file and csv_file:
         # --- Column Mapping Interface ---
         st.subheader("3. Map CSV Columns")
         with st.expander("Click to adjust column mapping", expanded=False):
-            columns = df.columns.tolist()
+            columns = st.session_state._columns
             col1, col2 = st.columns(2)
             with col1:
                 col_prefix = st.selectbox("Prefix (นาย/นางสาว)", columns, index=2 if len(columns) > 2 else 0)
@@ -70,15 +108,37 @@ if docx_file and csv_file:
             with col2:
                 col_id = st.selectbox("ID Card", columns, index=5 if len(columns) > 5 else 0)
                 col_address = st.selectbox("Address", columns, index=9 if len(columns) > 9 else 0)
+            
+            # dict.fromkeys drops duplicates when one column is mapped twice
+            mapped_columns = list(dict.fromkeys([col_prefix, col_name, col_surname, col_id, col_address]))
+            
+            if st.button("Confirm mapping"):
+                # Replace the full frame with just the mapped columns
+                st.session_state._df = load_csv(csv_file.getvalue(), usecols=tuple(mapped_columns))
+        
+        # A mapping changed after confirming can need columns the slim frame no longer has
+        if not set(mapped_columns) <= set(st.session_state._df.columns):
+            st.session_state._df = load_csv(csv_file.getvalue())
+        df = st.session_state._df
 
         st.markdown("---")
         
         # --- Bulk Selection Interface ---
         st.subheader("4. Select People for Contracts")
         
-        # Insert Select column
-        df_with_selections = df.copy()
-        df_with_selections.insert(0, "Select", False)
+        # Rebuild the table only when the upload or the mapping changes
+        # (full and slim frames hold the same values, so confirming keeps the ticks)
+        selection_key = (csv_key, tuple(mapped_columns))
+        if st.session_state.get('_selection_key') != selection_key:
+            # Only the mapped columns are shown, so copy just that projection
+            df_with_selections = df[mapped_columns].copy()
+            
+            # Insert Select column
+            df_with_selections.insert(0, "Select", pd.array([False] * len(df), dtype="boolean"))
+            
+            st.session_state._df_with_selections = df_with_selections
+            st.session_state._selection_key = selection_key
+        df_with_selections = st.session_state._df_with_selections
         
         # Display data editor
         edited_df = st.data_editor(
@@ -86,7 +146,7 @@ if docx_file and csv_file:
             column_config={
                 "Select": st.column_config.CheckboxColumn("Generate?", default=False)
             },
-            disabled=df.columns,
+            disabled=mapped_columns,
             hide_index=True,
         )
         
@@ -96,70 +156,88 @@ if docx_file and csv_file:
         # --- Generation Logic ---
         st.write(f"**Selected: {len(selected_rows)} people**")
         
+        # A generated archive is only offered while the inputs it was built from are unchanged
+        batch_key = (csv_key, docx_file.file_id, start_contract_id, tuple(mapped_columns), tuple(selected_rows.index))
+        if st.session_state.get('_zip_key') != batch_key:
+            discard_zip()
+        
         if st.button("Generate Selected Contracts", type="primary"):
             if len(selected_rows) == 0:
                 st.warning("Please select at least one person.")
             else:
-                zip_buffer = io.BytesIO()
+                template_bytes = docx_file.getvalue()
                 progress_bar = st.progress(0)
                 
-                with zipfile.ZipFile(zip_buffer, "w") as zf:
-                    # Iterate through selected rows with an index counter (0, 1, 2...)
-                    for i, (index, row) in enumerate(selected_rows.iterrows()):
-                        
-                        # GENERATE DYNAMIC ID
-                        current_contract_id = increment_id(start_contract_id, i)
-                        
-                        # Prepare data
-                        p_prefix = str(row[col_prefix])
-                        p_name = str(row[col_name])
-                        p_surname = str(row[col_surname])
-                        p_id = str(row[col_id])
-                        p_address = str(row[col_address])
-                        p_sign_name = f"{p_prefix} {p_name} {p_surname}"
-                        
-                        # Context
-                        context = {
-                            'contract_id': current_contract_id, # Auto-running ID
-                            'prefix': p_prefix,
-                            'name': p_name,
-                            'surname': p_surname,
-                            'id_card': p_id,
-                            'address': p_address,
-                            'sign_name': p_sign_name
-                        }
-                        
-                        # Render doc
-                        docx_file.seek(0) 
-                        doc = DocxTemplate(docx_file)
-                        doc.render(context)
-                        
-                        # Save to stream
-                        doc_io = io.BytesIO()
-                        doc.save(doc_io)
-                        doc_io.seek(0)
-                        
-                        # File name now includes the running ID for easy sorting
-                        filename = f"{current_contract_id}_{p_name}.docx"
-                        # Sanitize filename (remove slashes that might break zip)
-                        filename = filename.replace("/", "-").replace("\\", "-")
-                        
-                        zf.writestr(filename, doc_io.getvalue())
-                        
-                        progress_bar.progress((i + 1) / len(selected_rows))
+                # Prepare every contract up front so rendering can run in parallel
+                increment_id = make_id_incrementer(start_contract_id)
+                contexts = []
+                filenames = []
+                # Plain tuples in mapping order avoid building a Series per row
+                rows = selected_rows[[col_prefix, col_name, col_surname, col_id, col_address]]
+                # Iterate through selected rows with an index counter (0, 1, 2...)
+                for i, row in enumerate(rows.itertuples(index=False, name=None)):
+                    
+                    # GENERATE DYNAMIC ID
+                    current_contract_id = increment_id(i)
+                    
+                    # Prepare data
+                    p_prefix, p_name, p_surname, p_id, p_address = map(str, row)
+                    p_sign_name = f"{p_prefix} {p_name} {p_surname}"
+                    
+                    # Context
+                    contexts.append({
+                        'contract_id': current_contract_id, # Auto-running ID
+                        'prefix': p_prefix,
+                        'name': p_name,
+                        'surname': p_surname,
+                        'id_card': p_id,
+                        'address': p_address,
+                        'sign_name': p_sign_name
+                    })
+                    
+                    # File name now includes the running ID for easy sorting
+                    filename = f"{current_contract_id}_{p_name}.docx"
+                    # Sanitize filename (remove slashes that might break zip)
+                    filenames.append(filename.replace("/", "-").replace("\\", "-"))
                 
-                zip_buffer.seek(0)
-                st.success(f"Generated {len(selected_rows)} contracts starting from ID: {start_contract_id}")
+                # Write the archive to a temp file that deletes itself when closed or garbage collected,
+                # so it goes away when replaced, when generation fails and when the session ends
+                zip_file = tempfile.NamedTemporaryFile(suffix=".zip")
+                try:
+                    # .docx files are already deflated, so store them as-is
+                    with zipfile.ZipFile(zip_file, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+                        # Render docs across all cores; results come back in selection order
+                        written = write_all(zf, template_bytes, contexts, filenames)
+                        # Refresh the progress bar ~100 times per batch rather than once per contract
+                        progress_step = max(1, len(contexts) // 100)
+                        for i, _ in enumerate(written):
+                            if i % progress_step == 0 or i == len(contexts) - 1:
+                                progress_bar.progress((i + 1) / len(contexts))
+                    zip_file.flush()
+                except Exception:
+                    zip_file.close()
+                    raise
+                
+                # Keep only the latest archive per session
+                discard_zip()
+                st.session_state._zip_file = zip_file
+                st.session_state._zip_key = batch_key
                 
-                st.download_button(
-                    label="⬇️ Download All as ZIP",
-                    data=zip_buffer,
-                    file_name="Contracts_Running_ID.zip",
-                    mime="application/zip"
-                )
+                st.success(f"Generated {len(selected_rows)} contracts starting from ID: {start_contract_id}")
+        
+        # The archive is only read from disk when the button is clicked (deferred download data)
+        zip_file = st.session_state.get('_zip_file')
+        if zip_file is not None:
+            st.download_button(
+                label="⬇️ Download All as ZIP",
+                data=lambda zip_file=zip_file: read_zip(zip_file),
+                file_name="Contracts_Running_ID.zip",
+                mime="application/zip"
+            )
 
     except Exception as e:
         st.error(f"An error occurred: {e}")
 
 else:
+    discard_zip()
     st.info("Please upload .docx template and .csv data.")
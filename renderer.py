@@ -0,0 +1,208 @@
+from docxtpl import DocxTemplate
+from docx import Document
+from jinja2 import Environment
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+import collections
+import contextlib
+import copy
+import functools
+import io
+import multiprocessing
+import os
+import posixpath
+import re
+import sys
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+
+# Batches smaller than this are rendered in-process; pool start-up would cost more than it saves
+PARALLEL_MIN_BATCH = 8
+# Rendered documents in flight (queued, rendering or waiting to be written) per worker
+PARALLEL_WINDOW_PER_WORKER = 2
+
+# Relationship types (last URI segment) of the parts docxtpl renders
+_PACKAGE_REL_TYPES = ('officeDocument', 'core-properties')
+_DOCUMENT_REL_TYPES = ('header', 'footer', 'footnotes')
+_RELS_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+# A plain {{ field }} placeholder that sits inside a single text run
+_FLAT_TAG = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+# Any Jinja delimiter or docxtpl {_ _} brace escape; left over after removing flat tags,
+# it means the template needs docxtpl
+_JINJA_DELIMITER = re.compile(r'\{[{%#_]|[}%#_]\}')
+# Same rule docxtpl's patch_xml uses to keep spaces around tags in <w:t> elements
+_PRESERVE_SPACE = re.compile(r'<w:t>((?:(?!<w:t>).)*)(\{\{.*?\}\})', re.DOTALL)
+# Characters docxtpl turns into line breaks, tabs, paragraphs and page breaks
+_LISTING_CHARS = re.compile(r'[\n\t\a\f]')
+
+# One Jinja environment per process, shared by every docxtpl render (same defaults docxtpl uses)
+_JINJA_ENV = Environment()
+
+# --- Helper Functions for Template Caching ---
+@functools.lru_cache(maxsize=4)
+def load_template(template_bytes):
+    # Parse the .docx once per process; renders only ever touch deep copies of it
+    return Document(io.BytesIO(template_bytes))
+
+def new_template(template_bytes):
+    doc = DocxTemplate(io.BytesIO(template_bytes))
+    doc.docx = copy.deepcopy(load_template(template_bytes))
+    return doc
+
+def _related_parts(zin, source):
+    # (relationship type, part name) pairs from the .rels of source ('' for the package itself)
+    directory, base = posixpath.split(source)
+    rels_name = posixpath.join(directory, '_rels', base + '.rels')
+    if rels_name not in zin.namelist():
+        return
+    for rel in ET.fromstring(zin.read(rels_name)).iter(_RELS_NS + 'Relationship'):
+        if rel.get('TargetMode') == 'External':
+            continue
+        target = rel.get('Target', '')
+        if target.startswith('/'):
+            name = target[1:]
+        else:
+            name = posixpath.normpath(posixpath.join(directory, target))
+        yield rel.get('Type', '').rsplit('/', 1)[-1], name
+
+def _rendered_part_names(zin):
+    # Resolve body, headers, footers, footnotes and core properties through the rels, as docxtpl does
+    # Empty when no main document part is found, so unusual packages go to docxtpl
+    names = []
+    has_document = False
+    for rel_type, name in _related_parts(zin, ''):
+        if rel_type not in _PACKAGE_REL_TYPES:
+            continue
+        names.append(name)
+        if rel_type == 'officeDocument':
+            has_document = True
+            names += [part for part_type, part in _related_parts(zin, name) if part_type in _DOCUMENT_REL_TYPES]
+    return names if has_document else []
+
+@functools.lru_cache(maxsize=4)
+def flat_template_parts(template_bytes):
+    # Rendered parts of a flat template, with space preservation patched in as docxtpl would;
+    # None when the template needs docxtpl (any tag that is not a plain {{ field }})
+    parts = {}
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as zin:
+        names = _rendered_part_names(zin)
+        if not names:
+            return None
+        for name in names:
+            try:
+                xml = zin.read(name).decode('utf-8')
+            except (KeyError, UnicodeDecodeError):
+                return None
+            if _JINJA_DELIMITER.search(_FLAT_TAG.sub('', xml)):
+                return None
+            parts[name] = _PRESERVE_SPACE.sub(r'<w:t xml:space="preserve">\1\2', xml)
+    return parts
+
+def is_flat_template(template_bytes):
+    # True when every tag is a plain {{ field }}, so the XML can be filled in without docxtpl
+    return flat_template_parts(template_bytes) is not None
+
+# --- Rendering ---
+def render_flat(template_bytes, context, fp):
+    # Fast path: substitute placeholders straight into the XML, skipping Jinja and lxml
+    values = {key: escape(str(value)) for key, value in context.items()}
+    # Unknown fields render empty, like Jinja's default Undefined
+    fill = lambda match: values.get(match.group(1), '')
+    parts = flat_template_parts(template_bytes)
+
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as zin, \
+            zipfile.ZipFile(fp, 'w', compression=zipfile.ZIP_DEFLATED) as zout:
+        for item in zin.infolist():
+            if item.filename in parts:
+                data = _FLAT_TAG.sub(fill, parts[item.filename]).encode('utf-8')
+            else:
+                data = zin.read(item)
+            zout.writestr(item, data, compress_type=zipfile.ZIP_DEFLATED)
+
+def render_into(template_bytes, context, fp):
+    # Writes the rendered .docx to the binary file object fp (which need not be seekable)
+    # Values with line breaks or tabs need docxtpl's listing handling, so they skip the fast path
+    if is_flat_template(template_bytes) and \
+            not any(_LISTING_CHARS.search(str(value)) for value in context.values()):
+        render_flat(template_bytes, context, fp)
+        return
+
+    doc = new_template(template_bytes)
+    doc.render(context, jinja_env=_JINJA_ENV)
+    doc.save(fp)
+
+def render_one(template_bytes, context):
+    # Save to stream
+    doc_io = io.BytesIO()
+    render_into(template_bytes, context, doc_io)
+    return doc_io.getvalue()
+
+# Set once per worker so the template is not pickled along with every task
+_worker_template_bytes = None
+
+def _init_worker(template_bytes):
+    global _worker_template_bytes
+    _worker_template_bytes = template_bytes
+
+def _render_in_worker(context):
+    return render_one(_worker_template_bytes, context)
+
+@contextlib.contextmanager
+def _renderer_as_main():
+    # Streamlit registers the app script as __main__, which new workers would re-run as
+    # __mp_main__; point it at this module while the pool starts processes
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+@functools.lru_cache(maxsize=None)
+def _mp_context():
+    # forkserver rather than fork: forking the multi-threaded Streamlit server can deadlock.
+    # The server preloads this module, so workers start without re-importing docxtpl/lxml.
+    # Where forkserver is unavailable (Windows) workers are spawned instead.
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['renderer'])
+    return context
+
+def write_all(zf, template_bytes, contexts, filenames):
+    # Renders each context into zf under the matching file name, in order, yielding after every entry
+    workers = os.cpu_count() or 1
+    if workers == 1 or len(contexts) < PARALLEL_MIN_BATCH:
+        # In-process renders stream straight into their zip entry, with no intermediate buffer
+        for context, filename in zip(contexts, filenames):
+            info = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+            with zf.open(info, 'w', force_zip64=True) as dest:
+                render_into(template_bytes, context, dest)
+            yield
+        return
+
+    # Worker results have to cross the process boundary as bytes anyway
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=_mp_context(),
+        initializer=_init_worker,
+        initargs=(template_bytes,),
+    ) as ex:
+        # Submit in a bounded window so at most a few documents per worker are held in memory
+        window = workers * PARALLEL_WINDOW_PER_WORKER
+        pending = collections.deque()
+        for context, filename in zip(contexts, filenames):
+            # Workers are started lazily by submit()
+            with _renderer_as_main():
+                future = ex.submit(_render_in_worker, context)
+            pending.append((filename, future))
+            if len(pending) < window:
+                continue
+            filename, future = pending.popleft()
+            zf.writestr(filename, future.result())
+            yield
+        while pending:
+            filename, future = pending.popleft()
+            zf.writestr(filename, future.result())
+            yield